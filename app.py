@@ -2,9 +2,12 @@ from flask import Flask, render_template, jsonify, request, send_file
 import requests
 from datetime import datetime, timedelta
 import json
+import math
 import os
+import re
 from groq import Groq
 import boto3
+from botocore.exceptions import ClientError
 import uuid
 from elevenlabs import ElevenLabs
 
@@ -46,6 +49,34 @@ def fetch_recent_papers(url="https://medrxiv.org/collection/cardiovascular-medic
     return data
 
 
+def normalize_doi(doi):
+    """
+    Strip the resolver prefix from a DOI
+    """
+    if doi.startswith('https://doi.org/'):
+        doi = doi.replace('https://doi.org/', '')
+    return doi
+
+
+def extract_paper_text(doi):
+    """
+    Extract the full text of a medRxiv paper using Firecrawl
+    
+    Args:
+        doi (str): DOI of the paper, with or without the https://doi.org/ prefix
+        
+    Returns:
+        dict: Firecrawl extraction response
+    """
+    # Construct the PDF URL
+    pdf_url = f"https://www.medrxiv.org/content/{normalize_doi(doi)}.full.pdf"
+    
+    # Extract full text using Firecrawl with token limit
+    return firecrawl_app.extract([pdf_url], {
+        'prompt': 'Extract the full text of this research paper. Exclude URL links and author names. Limit the extracted text to approximately 5500 tokens to ensure the total response is under 6000 tokens.',
+    })
+
+
 def get_full_paper_text(paper_index=0):
     """
     Get the full text of a paper returned by fetch_recent_papers
@@ -77,19 +108,7 @@ def get_full_paper_text(paper_index=0):
     if not doi:
         return {"error": f"No DOI found for paper at index {paper_index}"}
     
-    # Extract just the DOI part if it's a full URL
-    if doi.startswith('https://doi.org/'):
-        doi = doi.replace('https://doi.org/', '')
-    
-    # Construct the PDF URL
-    pdf_url = f"https://www.medrxiv.org/content/{doi}.full.pdf"
-    
-    # Extract full text using Firecrawl with token limit
-    full_text_data = firecrawl_app.extract([pdf_url], {
-        'prompt': 'Extract the full text of this research paper. Exclude URL links and author names. Limit the extracted text to approximately 5500 tokens to ensure the total response is under 6000 tokens.',
-    })
-    
-    return full_text_data
+    return extract_paper_text(doi)
 
 
 # API endpoint to fetch recent papers
@@ -342,17 +361,10 @@ def get_local_paper_text():
         return jsonify({"error": "No DOI found for the first paper"})
     
     # Extract just the DOI part if it's a full URL
-    if doi.startswith('https://doi.org/'):
-        doi = doi.replace('https://doi.org/', '')
-    
-    # Construct the PDF URL
-    pdf_url = f"https://www.medrxiv.org/content/{doi}.full.pdf"
+    doi = normalize_doi(doi)
     
-    # Extract full text using Firecrawl with token limit
     try:
-        full_text_data = firecrawl_app.extract([pdf_url], {
-            'prompt': 'Extract the full text of this research paper. Exclude URL links and author names. Limit the extracted text to approximately 5500 tokens to ensure the total response is under 6000 tokens.',
-        })
+        full_text_data = extract_paper_text(doi)
         
         return jsonify({
             "success": True,
@@ -520,16 +532,283 @@ def upload_to_s3(file_data, file_name, content_type='audio/mpeg'):
         print(f"Error uploading to S3: {str(e)}")
         raise
 
+def download_from_s3(file_name):
+    """
+    Download a file from S3 bucket
+    
+    Without s3:ListBucket permission S3 reports a missing key as 403
+    AccessDenied rather than 404, so both are treated as a missing file.
+    
+    Args:
+        file_name (str): The name of the file in S3
+        
+    Returns:
+        bytes: The file data, or None if the file does not exist
+    """
+    try:
+        bucket_name = os.getenv('S3_BUCKET_NAME')
+        response = s3_client.get_object(Bucket=bucket_name, Key=file_name)
+        return response['Body'].read()
+    except ClientError as e:
+        error_code = e.response.get('Error', {}).get('Code')
+        if error_code in ('404', 'NoSuchKey'):
+            return None
+        if error_code in ('403', 'AccessDenied'):
+            print(f"Access denied reading {file_name} from S3, treating it as missing. "
+                  "Check that the IAM policy allows s3:GetObject on this key.")
+            return None
+        raise
+
+
+# Default narrator voice (Antoni)
+DEFAULT_VOICE_ID = "ErXwobaYiN019PkySvjV"
+
+# ElevenLabs voice ids; voice names are rejected so each narrator has one
+# set of stored segments
+VOICE_ID_PATTERN = re.compile(r'^[A-Za-z0-9]{20}$')
+
+# Approximate narration speed used to size scripts to a duration
+WORDS_PER_MINUTE = 150
+
+# Target word counts for stored per-paper segments, shortest first
+SEGMENT_LENGTH_TIERS = {
+    "short": 150,
+    "medium": 300,
+    "long": 600,
+}
+
+# Version of the stored segment library; bump it whenever the segment
+# prompt, host persona, SEGMENT_LENGTH_TIERS or TTS model changes so old
+# segments are no longer reused
+SEGMENT_LIBRARY_VERSION = "v1"
+
+# Word count bounds for each of the freshly generated intro and outro
+MIN_FRAMING_WORDS = 60
+MAX_FRAMING_WORDS = 300
+
+
+def synthesize_audio(text, voice=DEFAULT_VOICE_ID):
+    """
+    Narrate text with ElevenLabs
+    
+    Args:
+        text (str): The script to narrate
+        voice (str): The ElevenLabs voice id
+        
+    Returns:
+        bytearray: MP3 audio data
+    """
+    eleven_api_key = os.getenv("ELEVENLABS_API_KEY")
+    if not eleven_api_key:
+        raise RuntimeError("ELEVENLABS_API_KEY environment variable not set")
+    
+    eleven = ElevenLabs(api_key=eleven_api_key)
+    
+    audio_generator = eleven.generate(
+        text=text,
+        voice=voice,
+        model="eleven_turbo_v2"
+    )
+    
+    # Collect all audio chunks
+    audio_chunks = bytearray()
+    for chunk in audio_generator:
+        audio_chunks.extend(chunk)
+    return audio_chunks
+
+
+def plan_segment_tiers(duration, paper_count):
+    """
+    Choose a length tier for each paper so the segments fill as much of
+    the requested duration as possible
+    
+    Every paper starts at the shortest tier and papers are upgraded one
+    step at a time while the segments still leave room for a minimal
+    intro and outro. Whatever time is left over goes to the intro and
+    outro, see framing_word_count.
+    
+    Args:
+        duration (float): Requested episode length in minutes
+        paper_count (int): Number of papers covered in the episode
+        
+    Returns:
+        list: One key into SEGMENT_LENGTH_TIERS per paper
+    """
+    tier_names = list(SEGMENT_LENGTH_TIERS)
+    budget = duration * WORDS_PER_MINUTE - 2 * MIN_FRAMING_WORDS
+    tiers = [tier_names[0]] * paper_count
+    total_words = SEGMENT_LENGTH_TIERS[tier_names[0]] * paper_count
+    
+    for level in range(1, len(tier_names)):
+        extra_words = SEGMENT_LENGTH_TIERS[tier_names[level]] - SEGMENT_LENGTH_TIERS[tier_names[level - 1]]
+        for i in range(paper_count):
+            if tiers[i] == tier_names[level - 1] and total_words + extra_words <= budget:
+                tiers[i] = tier_names[level]
+                total_words += extra_words
+    return tiers
+
+
+def framing_word_count(duration, segment_words):
+    """
+    Split the time not covered by segments between the intro and outro
+    
+    Args:
+        duration (float): Requested episode length in minutes
+        segment_words (int): Total words in the episode's segments
+        
+    Returns:
+        int: Target word count for each of the intro and outro
+    """
+    remaining_words = duration * WORDS_PER_MINUTE - segment_words
+    return int(min(max(remaining_words / 2, MIN_FRAMING_WORDS), MAX_FRAMING_WORDS))
+
+
+class SegmentError(Exception):
+    """
+    Raised when a segment cannot be generated because of a problem with
+    the paper itself, such as missing text or a failed summary
+    """
+
+
+def segment_key(doi, voice, tier):
+    """
+    Build the S3 key prefix for a stored segment
+    """
+    return f"segments/{SEGMENT_LIBRARY_VERSION}/{normalize_doi(doi).replace('/', '_')}/{voice}/{tier}"
+
+
+def get_or_create_segment(paper, voice, tier):
+    """
+    Load a narrated paper segment from the segment library, generating
+    and storing it on first use
+    
+    Segments are keyed by library version, DOI, voice and length tier, so
+    a paper is only summarized and narrated once for each combination
+    regardless of the specialty or duration of the episodes it appears in.
+    
+    Args:
+        paper (dict): Paper metadata with 'doi' and 'title'
+        voice (str): The ElevenLabs voice id
+        tier (str): Key into SEGMENT_LENGTH_TIERS
+        
+    Returns:
+        dict: Segment with 'transcript', 'audio' and 'cached' keys
+        
+    Raises:
+        SegmentError: If the paper text cannot be extracted or summarized
+    """
+    key = segment_key(paper['doi'], voice, tier)
+    
+    # Reuse the stored segment if both transcript and audio exist
+    transcript_data = download_from_s3(f"{key}.json")
+    if transcript_data is not None:
+        audio = download_from_s3(f"{key}.mp3")
+        if audio is not None:
+            return {
+                "transcript": json.loads(transcript_data)['transcript'],
+                "audio": audio,
+                "cached": True
+            }
+    
+    try:
+        full_text_data = extract_paper_text(paper['doi'])
+    except Exception as e:
+        raise SegmentError(f"Failed to extract paper text for {paper['doi']}: {str(e)}")
+    
+    paper_text = ""
+    if full_text_data.get("success") and full_text_data.get("data"):
+        paper_text = full_text_data["data"].get("extractedText", "")
+    if not paper_text:
+        raise SegmentError(f"Could not find paper text for {paper['doi']}")
+    
+    segment_prompt = f"""Write a self-contained podcast segment discussing this medical research paper,
+    titled "{paper.get('title', 'Unknown Title')}".
+    Target length is about {SEGMENT_LENGTH_TIERS[tier]} words. Focus on key findings, clinical
+    implications, and what makes this research noteworthy.
+    It is narrated by a single host named Dr. Varanasi who has a conversational style.
+    Do not include a welcome, introduction to the show, or sign-off, since the segment
+    will be placed between other segments in an episode.
+    Only output the words to be spoken."""
+    
+    analysis = analyze_paper_with_groq(paper_text, segment_prompt)
+    if not analysis.get('success'):
+        raise SegmentError(f"Failed to generate segment for {paper['doi']}: {analysis.get('error')}")
+    
+    transcript = analysis['analysis']
+    audio = synthesize_audio(transcript, voice)
+    
+    # Store the segment for reuse by later episodes; a failed write only
+    # loses the cache entry, not the segment
+    try:
+        upload_to_s3(audio, f"{key}.mp3")
+        upload_to_s3(
+            json.dumps({
+                "doi": normalize_doi(paper['doi']),
+                "title": paper.get('title'),
+                "voice": voice,
+                "tier": tier,
+                "transcript": transcript
+            }),
+            f"{key}.json",
+            content_type='application/json'
+        )
+    except Exception as e:
+        print(f"Error storing segment {key}: {str(e)}")
+    
+    return {
+        "transcript": transcript,
+        "audio": audio,
+        "cached": False
+    }
+
+
+def generate_framing_script(specialty, papers, part, word_count=MIN_FRAMING_WORDS):
+    """
+    Generate a short episode intro or outro with Groq
+    
+    Args:
+        specialty (str): The episode specialty
+        papers (list): Paper metadata for the papers covered
+        part (str): Either 'intro' or 'outro'
+        word_count (int): Target length of the script in words
+        
+    Returns:
+        str: The narration script
+    """
+    titles = "\n".join(f"- {paper.get('title', 'Unknown Title')}" for paper in papers)
+    if part == 'intro':
+        instructions = f"""Write a warm welcome and introduction, of about {word_count} words, for a podcast
+        episode about recent developments in {specialty}. Briefly preview the papers below."""
+    else:
+        instructions = f"""Write a conclusion with takeaways, of about {word_count} words, for a podcast
+        episode about recent developments in {specialty} that discussed the papers below."""
+    
+    prompt = f"""{instructions}
+    The podcast is aimed at medical professionals who want to stay updated on recent research.
+    It is narrated by a single host named Dr. Varanasi who has a conversational style.
+    Only output the words to be spoken."""
+    
+    result = analyze_paper_with_groq(titles, prompt)
+    if not result.get('success'):
+        raise RuntimeError(f"Failed to generate {part}")
+    return result['analysis']
+
+
 @app.route('/generate-podcast', methods=['POST'])
 def generate_podcast():
     """
     Generate a new podcast based on the provided parameters
+    
+    The episode is assembled from a freshly narrated intro and outro plus
+    per-paper segments from the segment library. The MP3 parts share the
+    same voice and model, so they are concatenated without re-synthesis.
     """
     try:
         data = request.get_json()
         specialty = data.get('specialty')
         duration = data.get('duration')
         frequency = data.get('frequency')
+        voice = data.get('voice') or DEFAULT_VOICE_ID
 
         if not specialty or not duration:
             return jsonify({
@@ -537,63 +816,92 @@ def generate_podcast():
                 "error": "Missing required parameters"
             }), 400
 
+        try:
+            # bool is an int subclass, so True would otherwise mean 1 minute
+            duration_minutes = 0 if isinstance(duration, bool) else float(duration)
+        except (TypeError, ValueError):
+            duration_minutes = 0
+        
+        if not math.isfinite(duration_minutes) or duration_minutes <= 0:
+            return jsonify({
+                "success": False,
+                "error": "Duration must be a positive number of minutes"
+            }), 400
+
+        if not isinstance(voice, str) or not VOICE_ID_PATTERN.match(voice):
+            return jsonify({
+                "success": False,
+                "error": "Invalid voice id"
+            }), 400
+
+        # Check service configuration before any paid calls are made
+        for api_key_name in ("GROQ_API_KEY", "ELEVENLABS_API_KEY"):
+            if not os.getenv(api_key_name):
+                return jsonify({
+                    "success": False,
+                    "error": f"{api_key_name} environment variable not set"
+                }), 500
+
         # Get recent papers for the specialty
         papers_data = fetch_recent_papers()
         
-        if not papers_data.get('success'):
+        if not papers_data.get('success') or not papers_data.get('data') or not papers_data.get('data').get('papers'):
             return jsonify({
                 "success": False,
                 "error": "Failed to fetch papers"
             }), 500
 
-        # Generate podcast transcript
-        podcast_prompt = f"""
-        Create an engaging {duration}-minute podcast transcript about recent developments in {specialty}.
-        The podcast should have:
-        1. A warm welcome and introduction
-        2. Discussion of each paper with smooth transitions between topics
-        3. A brief conclusion with takeaways
-        
-        The podcast is aimed at medical professionals who want to stay updated on recent research.
-        Include only one host named Dr. Varanasi who has a conversational style.
-        """
-
-        # Generate transcript using Groq
-        transcript = analyze_paper_with_groq(podcast_prompt, "")
+        papers = [paper for paper in papers_data['data']['papers'] if paper.get('doi')]
         
-        if not transcript.get('success'):
+        if not papers:
             return jsonify({
                 "success": False,
-                "error": "Failed to generate transcript"
+                "error": "Failed to fetch papers"
             }), 500
+        
+        tiers = plan_segment_tiers(duration_minutes, len(papers))
 
         try:
-            # Initialize ElevenLabs client
-            eleven_api_key = os.getenv("ELEVENLABS_API_KEY")
+            segments = []
+            included_papers = []
+            included_tiers = []
+            
+            # Skip papers whose segment cannot be generated
+            for paper, tier in zip(papers, tiers):
+                try:
+                    segments.append(get_or_create_segment(paper, voice, tier))
+                    included_papers.append(paper)
+                    included_tiers.append(tier)
+                except SegmentError as e:
+                    print(f"Skipping paper {paper.get('doi')}: {str(e)}")
             
-            if not eleven_api_key:
+            if not segments:
                 return jsonify({
                     "success": False,
-                    "error": "ELEVENLABS_API_KEY environment variable not set"
+                    "error": "Failed to generate any paper segments"
                 }), 500
             
-            eleven = ElevenLabs(api_key=eleven_api_key)
+            # Give the time the segments leave over to the intro and outro
+            segment_words = sum(SEGMENT_LENGTH_TIERS[tier] for tier in included_tiers)
+            framing_words = framing_word_count(duration_minutes, segment_words)
+            intro = generate_framing_script(specialty, included_papers, 'intro', framing_words)
+            outro = generate_framing_script(specialty, included_papers, 'outro', framing_words)
             
-            # Generate a unique file name
-            podcast_id = str(uuid.uuid4())
-            file_name = f"podcasts/{podcast_id}.mp3"
+            # Concatenate intro, stored segments and outro
+            audio_chunks = bytearray(synthesize_audio(intro, voice))
+            for segment in segments:
+                audio_chunks.extend(segment['audio'])
+            audio_chunks.extend(synthesize_audio(outro, voice))
             
-            # Generate audio from text
-            audio_generator = eleven.generate(
-                text=transcript['analysis'],
-                voice="ErXwobaYiN019PkySvjV",  # Antoni voice
-                model="eleven_turbo_v2"
+            transcript = "\n\n".join(
+                [intro] + [segment['transcript'] for segment in segments] + [outro]
             )
+            estimated_minutes = round(len(transcript.split()) / WORDS_PER_MINUTE, 1)
+            print(f"Assembled podcast: requested {duration} min, estimated {estimated_minutes} min")
             
-            # Collect all audio chunks
-            audio_chunks = bytearray()
-            for chunk in audio_generator:
-                audio_chunks.extend(chunk)
+            # Generate a unique file name
+            podcast_id = str(uuid.uuid4())
+            file_name = f"podcasts/{podcast_id}.mp3"
             
             # Upload to S3
             audio_url = upload_to_s3(audio_chunks, file_name)
@@ -602,7 +910,10 @@ def generate_podcast():
                 "success": True,
                 "podcastId": podcast_id,
                 "audioUrl": audio_url,
-                "transcript": transcript['analysis']
+                "transcript": transcript,
+                "segmentTiers": included_tiers,
+                "estimatedMinutes": estimated_minutes,
+                "segmentsReused": sum(1 for segment in segments if segment['cached'])
             })
             
         except Exception as e:
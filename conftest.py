@@ -0,0 +1 @@
+# Keeps the repository root on sys.path so tests can import app.py
@@ -0,0 +1,103 @@
+import json
+
+import pytest
+
+import app
+
+
+def episode_words(duration, paper_count=3):
+    tiers = app.plan_segment_tiers(duration, paper_count)
+    segment_words = sum(app.SEGMENT_LENGTH_TIERS[tier] for tier in tiers)
+    return segment_words + 2 * app.framing_word_count(duration, segment_words)
+
+
+def test_plan_segment_tiers_mixes_tiers_to_fill_duration():
+    assert app.plan_segment_tiers(10, 3) == ['long', 'medium', 'medium']
+
+
+@pytest.mark.parametrize("duration", [5, 10, 15])
+def test_supported_durations_are_filled(duration):
+    assert episode_words(duration) == duration * app.WORDS_PER_MINUTE
+
+
+def test_short_duration_uses_minimum_episode():
+    assert app.plan_segment_tiers(1, 3) == ['short', 'short', 'short']
+    assert episode_words(1) / app.WORDS_PER_MINUTE == pytest.approx(3.8)
+
+
+def test_long_duration_is_capped():
+    assert app.plan_segment_tiers(30, 3) == ['long', 'long', 'long']
+    assert episode_words(30) / app.WORDS_PER_MINUTE == pytest.approx(16)
+
+
+PAPER = {"doi": "https://doi.org/10.1101/2025.02.25.25322843", "title": "Test paper"}
+
+
+def fail(*args, **kwargs):
+    raise AssertionError("unexpected call")
+
+
+def test_get_or_create_segment_reuses_stored_segment(monkeypatch):
+    stored = {
+        "segments/v1/10.1101_2025.02.25.25322843/voice/short.json": json.dumps({"transcript": "Stored"}).encode(),
+        "segments/v1/10.1101_2025.02.25.25322843/voice/short.mp3": b"mp3",
+    }
+    monkeypatch.setattr(app, "download_from_s3", stored.get)
+    monkeypatch.setattr(app, "extract_paper_text", fail)
+    monkeypatch.setattr(app, "synthesize_audio", fail)
+
+    segment = app.get_or_create_segment(PAPER, "voice", "short")
+
+    assert segment == {"transcript": "Stored", "audio": b"mp3", "cached": True}
+
+
+def test_get_or_create_segment_generates_and_stores_on_miss(monkeypatch):
+    uploads = {}
+    monkeypatch.setattr(app, "download_from_s3", lambda file_name: None)
+    monkeypatch.setattr(app, "extract_paper_text", lambda doi: {"success": True, "data": {"extractedText": "Text"}})
+    monkeypatch.setattr(app, "analyze_paper_with_groq", lambda text, prompt: {"success": True, "analysis": "Script"})
+    monkeypatch.setattr(app, "synthesize_audio", lambda text, voice: b"mp3")
+    monkeypatch.setattr(app, "upload_to_s3", lambda data, file_name, content_type='audio/mpeg': uploads.update({file_name: data}))
+
+    segment = app.get_or_create_segment(PAPER, "voice", "short")
+
+    assert segment == {"transcript": "Script", "audio": b"mp3", "cached": False}
+    key = "segments/v1/10.1101_2025.02.25.25322843/voice/short"
+    assert uploads[f"{key}.mp3"] == b"mp3"
+    assert json.loads(uploads[f"{key}.json"])["transcript"] == "Script"
+
+
+def test_get_or_create_segment_survives_failed_upload(monkeypatch):
+    def upload_fails(*args, **kwargs):
+        raise RuntimeError("S3 unavailable")
+
+    monkeypatch.setattr(app, "download_from_s3", lambda file_name: None)
+    monkeypatch.setattr(app, "extract_paper_text", lambda doi: {"success": True, "data": {"extractedText": "Text"}})
+    monkeypatch.setattr(app, "analyze_paper_with_groq", lambda text, prompt: {"success": True, "analysis": "Script"})
+    monkeypatch.setattr(app, "synthesize_audio", lambda text, voice: b"mp3")
+    monkeypatch.setattr(app, "upload_to_s3", upload_fails)
+
+    segment = app.get_or_create_segment(PAPER, "voice", "short")
+
+    assert segment == {"transcript": "Script", "audio": b"mp3", "cached": False}
+
+
+def test_get_or_create_segment_raises_segment_error_without_text(monkeypatch):
+    monkeypatch.setattr(app, "download_from_s3", lambda file_name: None)
+    monkeypatch.setattr(app, "extract_paper_text", lambda doi: {"success": True, "data": {}})
+    monkeypatch.setattr(app, "synthesize_audio", fail)
+
+    with pytest.raises(app.SegmentError):
+        app.get_or_create_segment(PAPER, "voice", "short")
+
+
+@pytest.mark.parametrize("duration", ["ten", True, -5])
+def test_generate_podcast_rejects_invalid_duration(monkeypatch, duration):
+    monkeypatch.setattr(app, "fetch_recent_papers", fail)
+
+    response = app.app.test_client().post(
+        '/generate-podcast',
+        json={"specialty": "Cardiology", "duration": duration}
+    )
+
+    assert response.status_code == 400